@@ -1,28 +1,170 @@
 import os
 import re
+import asyncio
+import ast
+import hashlib
+import json
+import diskcache
+import faiss
 import numpy as np
 from typing import TypedDict, List
 from langgraph.graph import StateGraph, END
 from langchain_core.prompts import ChatPromptTemplate
 import ollama
-import io
+import httpx
 import sys
-import traceback
+import threading
+import weakref
+import zlib
+from sandbox import ALLOWED_IMPORTS, FORBIDDEN_BUILTINS, compile_code, run_sandboxed
 
 # Initialize Ollama
-client = ollama.Client()
+# OLLAMA_HOSTS lists replicas as comma-separated URLs; unset means the default host.
+OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", "").split(",") if h.strip()] or [None]
+# Seconds a replica gets to answer the startup health check before it counts as down
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+# Event loop -> task resolving to the reachable endpoints as (client, slots) pairs.
+# Clients, their keep-alive connections and semaphores all belong to the loop that
+# created them, so every loop builds its own.
+_loop_endpoints = weakref.WeakKeyDictionary()
+
+
+async def loop_endpoints() -> List[tuple]:
+    loop = asyncio.get_running_loop()
+    if loop not in _loop_endpoints:
+        _loop_endpoints[loop] = loop.create_task(_connect())
+    return await _loop_endpoints[loop]
+
+
+async def _connect() -> List[tuple]:
+    # Extra keyword arguments are forwarded to the underlying httpx.AsyncClient, so
+    # every node shares one keep-alive pool per endpoint instead of reconnecting per request.
+    clients = [
+        ollama.AsyncClient(
+            host=host,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=40, keepalive_expiry=30),
+        )
+        for host in OLLAMA_HOSTS
+    ]
+
+    async def probe(client):
+        try:
+            # The clients have no timeout; a replica that accepts but never replies
+            # would otherwise hold up every question, healthy hosts included
+            await asyncio.wait_for(client.list(), HEALTH_CHECK_TIMEOUT)
+            return True
+        except (ollama.ResponseError, httpx.HTTPError, ConnectionError, asyncio.TimeoutError):
+            return False
+
+    # The /api/tags health check finishes before any question is routed, so the
+    # host a question is pinned to never changes while it is in progress.
+    up = await asyncio.gather(*[probe(client) for client in clients])
+    if any(up) and not all(up):
+        down = [str(host) for host, ok in zip(OLLAMA_HOSTS, up) if not ok]
+        print(f"Dropping unreachable Ollama hosts: {', '.join(down)}", file=sys.stderr)
+        clients = [client for client, ok in zip(clients, up) if ok]
+    # If nothing answered, every endpoint is kept and requests report the errors
+    return [(client, asyncio.Semaphore(MAX_PARALLEL_REQUESTS)) for client in clients]
 
 # ----------------------
 # Model Configuration
 # ----------------------
 MODEL_NAME = "qwen2.5-coder:32b"
+# The YES/NO gate and code review don't need the code model
+GATE_MODEL = "qwen2.5:1.5b-instruct-q4_K_M"
+VERIFY_MODEL = "qwen2.5:7b"
+# Also ask VERIFY_MODEL to review the logic of code that passes the static checks
+VERIFY_WITH_LLM = os.getenv("VERIFY_WITH_LLM", "0") == "1"
 TEMPERTURE = 0.3
+# Refinement rounds per question before giving up
+MAX_REFINEMENTS = int(os.getenv("MAX_REFINEMENTS", "3"))
+# Graph steps of the longest run: 6 to the first execution, 4 per refinement round
+# (refine, verify, join, execute) and 1 for refinement_limit, plus headroom
+GRAPH_RECURSION_LIMIT = 10 + 4 * MAX_REFINEMENTS
+# Cap on in-flight chat requests per endpoint; keep in line with the server's OLLAMA_NUM_PARALLEL.
+MAX_PARALLEL_REQUESTS = int(os.getenv("MAX_PARALLEL_REQUESTS", "8"))
+
+# Completions keyed by model, options and prompt; survives restarts.
+llm_cache = diskcache.Cache(os.getenv("LLM_CACHE_DIR", "./llm_cache"))
+# Event loop -> {cache key: task of the request currently fetching that completion}
+_inflight_chats = weakref.WeakKeyDictionary()
+
+# ----------------------
+# Semantic Cache
+# ----------------------
+EMBED_MODEL = "nomic-embed-text"
+# Minimum cosine similarity for a previous question to count as the same question
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "./semantic_cache")
+# Append-only log, one JSON line per stored answer:
+# {"embedding": [...], "numbers": [...], "final_answer": ..., "generated_code": ...}
+# The FAISS index is rebuilt from it on start, so a store never rewrites earlier answers.
+SEMANTIC_LOG_PATH = os.path.join(SEMANTIC_CACHE_DIR, "entries.jsonl")
+# Nearest neighbours checked for one whose numbers match the question
+SEMANTIC_CANDIDATES = 4
+# Embeddings barely separate "15 factorial" from "16 factorial", so hits also need the same literals
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def question_numbers(question: str) -> List[str]:
+    return _NUMBER_RE.findall(question)
+
+
+def _load_semantic_cache():
+    # Row i of the index belongs to entry i
+    if not os.path.exists(SEMANTIC_LOG_PATH):
+        return None, []
+    vectors, entries, line = [], [], ""
+    with open(SEMANTIC_LOG_PATH) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line torn by a crash mid-append
+                continue
+            vector = entry.pop("embedding")
+            # The embedding model changed at some point; only the original dimension fits
+            if vectors and len(vector) != len(vectors[0]):
+                continue
+            vectors.append(vector)
+            entries.append(entry)
+    if line and not line.endswith("\n"):
+        # End the torn line so the next append starts a line of its own
+        with open(SEMANTIC_LOG_PATH, "a") as f:
+            f.write("\n")
+    if not vectors:
+        return None, []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    return index, entries
+
+
+# Serializes appends from the worker threads of concurrent semantic_store calls
+_semantic_log_lock = threading.Lock()
+
+
+def _append_semantic_log(record: dict):
+    with _semantic_log_lock:
+        os.makedirs(SEMANTIC_CACHE_DIR, exist_ok=True)
+        with open(SEMANTIC_LOG_PATH, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+semantic_index, semantic_entries = _load_semantic_cache()
 
 class GraphState(TypedDict):
     question: str
+    question_embedding: List[float]
+    semantic_hit: bool
     math_related: bool
     generated_code: str
+    generation_key: str
+    static_verification: dict
+    llm_verification: dict
     verification_result: dict
+    execution_failed: bool
     refinements: List[str]
     final_answer: str
 
@@ -44,7 +186,7 @@ CODE_GENERATION_PROMPT = ChatPromptTemplate.from_messages([
 {question}
 
 Guidelines:
-1. Import only numpy as np
+1. Import only numpy as np (and numba, only when guideline 12 applies)
 2. Use vectorized operations
 3. Store final result in a variable called 'result'
 4. Print the result but do not include the print statement within any generated function; it should be outside.
@@ -54,7 +196,8 @@ Guidelines:
 8. The code should be as generalized as possible and the user prompt should be input to the generated function.
 9. If the user prompt is generic, generate the code and provide an example of how to use it.
 10. In the example provided don't get any input() calls.
-11. If the user has any specific requirements, include them in the code."""),
+11. If the user has any specific requirements, include them in the code.
+12. Prefer plain vectorized NumPy; numba's JIT compile costs about a second on every run. Only for large or iterative problems whose inner loops can't be vectorized (e.g. iterative solvers running many steps over big arrays), wrap the kernel in @numba.njit(fastmath=True). Do not pass cache=True or parallel=True."""),
 ])
 
 VERIFICATION_PROMPT = ChatPromptTemplate.from_messages([
@@ -70,11 +213,12 @@ Checklist:
 4. Alignment with problem requirements
 5. Code is parameterized and can be reused for different inputs.
      
-If the code is correct and aligns with the problem requirements, return the state 'APPROVED'. Otherwise, provide detailed feedback including errors such as the presence of input() calls."""),
+Respond ONLY with a JSON object of the form {{"approved": true, "issues": []}}.
+Set "approved" to true only if the code is correct and aligns with the problem requirements. Otherwise set it to false and list each problem, such as the presence of input() calls, as a short string in "issues"."""),
 ])
 
-REFINEMENT_PROMPT = ChatPromptTemplate.from_messages([
-    ("system", """Refine this code based on feedback. Original problem: {question}
+REFINE_AND_SELFCHECK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """Refine this code based on feedback, then verify your refined code. Original problem: {question}
 
 Original Code:
 {code}
@@ -82,114 +226,255 @@ Original Code:
 Feedback:
 {feedback}
 
-Generate improved code addressing all issues while ensuring no input() calls are present."""),
+Checklist for the refined code:
+1. Syntax validity
+2. Logical correctness
+3. Numerical stability
+4. Alignment with problem requirements
+5. Code is parameterized and can be reused for different inputs.
+6. No input() calls are present.
+
+Respond ONLY with a JSON object of the form {{"code": "<improved code>", "approved": true, "issues": []}}.
+"code" holds the complete improved Python code addressing all issues. Set "approved" to true only if that code passes the checklist. Otherwise set it to false and list each remaining problem as a short string in "issues"."""),
 ])
 
+# Local signals of a math question; a hit from either one skips the LLM gate.
+# An operator only counts between operands, at least one of them numeric (a digit or
+# parenthesis next to a digit, parenthesis or single-letter variable), so "3-paragraph",
+# "War 2 - its causes" or "A/B testing" don't look like arithmetic.
+MATH_SIGNALS = {
+    "operator": re.compile(
+        r"[\d)]\s*[-+*/^=]\s*(?:[\d(]|\b[a-z]\b)|\b[a-z]\b\s*[-+*/^=]\s*[\d(]",
+        re.I
+    ),
+    # Keywords like "log", "sum" or "mean" are everyday words too, so they only count
+    # when applied to a number, array or call: "log(8)", "sum of [1, 2]", "sin 30"
+    "keyword": re.compile(
+        r"\b(?:solve|integrate|derivative|matrix|eigen|sin|cos|log|sum|mean|std|"
+        r"variance|probability|equation)s?\s*(?:of\s+(?:the\s+)?)?[\d(\[]",
+        re.I
+    ),
+}
+_GATE_ANSWER_RE = re.compile(r"\b(?:YES|NO)\b", re.I)
+# The closing fence is optional: the code stop sequence below can cut it off
+_CODE_RE = re.compile(r'```python\n(.*?)\n?(?:```|\Z)', re.DOTALL)
+# Halts generation at the blank line after the code block, skipping trailing prose
+CODE_STOP = ["```\n\n"]
+GENERATION_OPTIONS = {"num_predict": 800, "stop": CODE_STOP}
+# Appended once to the feedback when a refine reply can't be parsed
+_NOT_JSON_NOTE = "The previous reply was not the requested JSON object."
+
 # ----------------------
 # Nodes
 # ----------------------
 
 
-def check_math_question(state: GraphState):
-    response = client.chat(
-        model=MODEL_NAME,
-        options={"temperature": TEMPERTURE},
-        messages=[{
-            "role": "user",
-            "content": MATH_CHECK_PROMPT.format(question=state["question"])
-        }]
+async def semantic_lookup(state: GraphState):
+    client, slots = await endpoint_for(state)
+    try:
+        async with slots:
+            response = await client.embed(model=EMBED_MODEL, input=state["question"])
+    except (ollama.ResponseError, httpx.HTTPError, ConnectionError):
+        # Without an embedding the question just takes the regular path
+        return {"semantic_hit": False}
+    vector = np.asarray(response["embeddings"][0], dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    if semantic_index is not None and semantic_index.ntotal and semantic_index.d == vector.size:
+        numbers = question_numbers(state["question"])
+        scores, ids = semantic_index.search(vector[None, :], SEMANTIC_CANDIDATES)
+        for score, i in zip(scores[0], ids[0]):
+            # Results are sorted by score; -1 pads when the index holds fewer rows
+            if score < SEMANTIC_THRESHOLD or not 0 <= i < len(semantic_entries):
+                break
+            entry = semantic_entries[i]
+            if entry.get("numbers") == numbers:
+                return {
+                    "semantic_hit": True,
+                    "final_answer": entry["final_answer"],
+                    "generated_code": entry["generated_code"]
+                }
+    return {"semantic_hit": False, "question_embedding": vector.tolist()}
+
+
+async def check_math_question(state: GraphState):
+    if any(pattern.search(state["question"]) for pattern in MATH_SIGNALS.values()):
+        return {"math_related": True}
+    # Ambiguous questions fall back to the LLM (whose answer is cached per question)
+    content = await cached_chat(
+        await endpoint_for(state),
+        MATH_CHECK_PROMPT.format(question=state["question"]),
+        model=GATE_MODEL,
+        options={"num_predict": 3},
+        until=_GATE_ANSWER_RE
     )
-    is_math = 'YES' in response['message']['content'].strip().upper()
+    is_math = 'YES' in content.strip().upper()
     return {"math_related": is_math}
 
 
-def generate_initial_code(state: GraphState):
-    response = client.chat(
-        model=MODEL_NAME,
-        options={"temperature": TEMPERTURE},
-        messages=[{
-            "role": "user",
-            "content": CODE_GENERATION_PROMPT.format(question=state["question"])
-        }]
-    )
-    code = extract_code(response['message']['content'])
-    return {"generated_code": code}
+async def generate_initial_code(state: GraphState):
+    prompt = CODE_GENERATION_PROMPT.format(question=state["question"])
+    # Only code that executed successfully is cached for this prompt (see execute_code)
+    content = await cached_chat(await endpoint_for(state), prompt, options=GENERATION_OPTIONS, store=False)
+    code = extract_code(content)
+    return {"generated_code": code, "generation_key": chat_key(prompt, options=GENERATION_OPTIONS)}
+
 
+def verify_static(state: GraphState):
+    issues = static_issues(state["generated_code"])
+    return {"static_verification": {"approved": not issues, "feedback": "\n".join(issues)}}
 
-def verify_code(state: GraphState):
-    # Check for forbidden input() calls before verification
+
+async def verify_llm(state: GraphState):
     code = state["generated_code"]
-    response = client.chat(
-        model=MODEL_NAME,
-        options={"temperature": TEMPERTURE},
-        messages=[{
-            "role": "user",
-            "content": VERIFICATION_PROMPT.format(
-                question=state["question"],
-                code=code
-            )
-        }]
+    # No point asking the LLM about code the static branch rejects; it reports the issues
+    if static_issues(code):
+        return {"llm_verification": {"approved": False, "feedback": ""}}
+    # Code that passes the static checks goes straight to execution, which serves as
+    # verification; a failed run reaches the LLM via refine_code
+    if not VERIFY_WITH_LLM:
+        return {"llm_verification": {"approved": True, "feedback": "local-ok"}}
+    content = await cached_chat(
+        await endpoint_for(state),
+        VERIFICATION_PROMPT.format(question=state["question"], code=code),
+        model=VERIFY_MODEL,
+        options={"num_predict": 256},
+        format="json"
     )
-    feedback = response['message']['content']
-    approved = 'APPROVED' in feedback.upper()
-    return {"verification_result": {"approved": approved, "feedback": feedback}}
-
-
-def refine_code(state: GraphState):
-    response = client.chat(
-        model=MODEL_NAME,
-        options={"temperature": TEMPERTURE},
-        messages=[{
-            "role": "user",
-            "content": REFINEMENT_PROMPT.format(
-                question=state["question"],
-                code=state["generated_code"],
-                feedback=state["verification_result"]["feedback"]
-            )
-        }]
-    )
-    new_code = extract_code(response['message']['content'])
-    return {"generated_code": new_code}
+    try:
+        verdict = json.loads(content)
+    except json.JSONDecodeError:
+        verdict = None
+    if not isinstance(verdict, dict):
+        # Unparseable verdicts count as rejections; the raw reply is the feedback
+        return {"llm_verification": {"approved": False, "feedback": content}}
+    approved = verdict.get("approved") is True
+    feedback = "\n".join(str(issue) for issue in verdict.get("issues") or [])
+    return {"llm_verification": {"approved": approved, "feedback": feedback}}
+
+
+def join_verify(state: GraphState):
+    verdicts = [state["static_verification"], state["llm_verification"]]
+    return {
+        "verification_result": {
+            "approved": all(v["approved"] for v in verdicts),
+            "feedback": "\n".join(v["feedback"] for v in verdicts if v["feedback"])
+        }
+    }
 
 
-def execute_code(state: GraphState):
+async def refine_code(state: GraphState):
+    feedback = state["verification_result"]["feedback"]
+    refinements = state.get("refinements", []) + [feedback]
+    # Exponential backoff keeps repeated failures from spinning in a tight loop
+    await asyncio.sleep(0.1 * 2 ** (len(refinements) - 1))
+    # Refinement and LLM verification share one round trip; verify_static still cross-checks
+    content = await cached_chat(
+        await endpoint_for(state),
+        REFINE_AND_SELFCHECK_PROMPT.format(
+            question=state["question"],
+            code=state["generated_code"],
+            feedback=feedback
+        ),
+        options={"num_predict": 1024},
+        format="json",
+        # A retry with unchanged code and feedback must ask the model again
+        store=False
+    )
     try:
-        loc = {"np": np}
-        # Capture printed output
-        output_capture = io.StringIO()
-        old_stdout = sys.stdout
-        sys.stdout = output_capture
+        reply = json.loads(content)
+    except json.JSONDecodeError:
+        reply = None
+    if not isinstance(reply, dict) or not isinstance(reply.get("code"), str):
+        # A truncated or malformed reply holds no usable code; the next round refines the previous one
+        return {
+            "generated_code": state["generated_code"],
+            "llm_verification": {
+                "approved": False,
+                # Keep the earlier feedback so the retry still sees the bug it has to fix
+                "feedback": (
+                    feedback if feedback.endswith(_NOT_JSON_NOTE) else f"{feedback}\n{_NOT_JSON_NOTE}"
+                )
+            },
+            "refinements": refinements
+        }
+    return {
+        # Models often fence the code even inside the JSON string
+        "generated_code": extract_code(reply["code"]),
+        "llm_verification": {
+            "approved": reply.get("approved") is True,
+            "feedback": "\n".join(str(issue) for issue in reply.get("issues") or [])
+        },
+        "refinements": refinements
+    }
 
-        try:
-            exec(state["generated_code"], loc)
-        finally:
-            sys.stdout = old_stdout
 
-        printed_output = output_capture.getvalue().strip()
+async def execute_code(state: GraphState):
+    # Runs in a child process; the thread keeps the event loop free for other questions
+    printed_output, error_message, stack_trace = await asyncio.to_thread(
+        run_sandboxed, state["generated_code"]
+    )
+    if error_message is None:
         final_text = (
             f"Final Code:\n\n```\n{state['generated_code']}\n```\n\n"
-            f"Printed Output:\n{printed_output}"
+            f"Printed Output:\n{printed_output.strip()}"
         )
+        if state.get("generation_key"):
+            # Later runs of this question start from code known to execute
+            llm_cache.set(state["generation_key"], f"```python\n{state['generated_code']}\n```")
         return {"final_answer": final_text, "execution_failed": False}
-    except Exception as e:
-        error_message = str(e)
-        # Capture the full stack trace as a string.
-        stack_trace = traceback.format_exc()
-        # Append both the error message and the stack trace to the feedback.
-        updated_feedback = f"\nExecution Error: {error_message}\nStack Trace:\n{stack_trace}"
-        final_text = (
-            f"Final Code:\n{state['generated_code']}\n\n"
-            f"Error in execution: {error_message}\n"
-            f"Stack Trace:\n{stack_trace}"
-        )
-        return {
-            "final_answer": final_text,
-            "execution_failed": True,
-            "verification_result": {
-                "approved": False,
-                "feedback": updated_feedback
-            }
+    # Append both the error message and the stack trace to the feedback.
+    updated_feedback = f"\nExecution Error: {error_message}\nStack Trace:\n{stack_trace}"
+    final_text = (
+        f"Final Code:\n{state['generated_code']}\n\n"
+        f"Error in execution: {error_message}\n"
+        f"Stack Trace:\n{stack_trace}"
+    )
+    return {
+        "final_answer": final_text,
+        "execution_failed": True,
+        "verification_result": {
+            "approved": False,
+            "feedback": updated_feedback
         }
+    }
+
+
+async def semantic_store(state: GraphState):
+    # The in-memory update runs on the event loop thread and never races another store
+    global semantic_index
+    embedding = state.get("question_embedding")
+    if not embedding:
+        return {}
+    vector = np.asarray(embedding, dtype=np.float32)[None, :]
+    if semantic_index is None:
+        semantic_index = faiss.IndexFlatIP(vector.shape[1])
+    elif semantic_index.d != vector.shape[1]:
+        # The embedding model changed; the existing index can't hold this vector
+        return {}
+    entry = {
+        "numbers": question_numbers(state["question"]),
+        "final_answer": state["final_answer"],
+        "generated_code": state["generated_code"]
+    }
+    semantic_entries.append(entry)
+    semantic_index.add(vector)
+    # Only the new answer is written, off the event loop so other questions keep running
+    await asyncio.to_thread(_append_semantic_log, {"embedding": embedding, **entry})
+    return {}
+
+
+def refinement_limit(state: GraphState):
+    # Out of refinement rounds: report the last attempt and every piece of feedback
+    sections = [f"Round {i}:\n{f.strip()}" for i, f in enumerate(state.get("refinements", []), 1)]
+    # The current verdict is on the last code, after every round was used up
+    sections.append(f"Final verdict:\n{state['verification_result']['feedback'].strip()}")
+    history = "\n\n".join(sections)
+    final_text = (
+        f"Gave up after {MAX_REFINEMENTS} refinements.\n\n"
+        f"Last Code:\n\n```\n{state['generated_code']}\n```\n\n"
+        f"Feedback:\n{history}"
+    )
+    return {"final_answer": final_text}
 
 
 def regular_response(state: GraphState):
@@ -201,9 +486,112 @@ def regular_response(state: GraphState):
 # ----------------------
 
 
+async def endpoint_for(state: GraphState) -> tuple:
+    # Every node of a question hits the same endpoint so its KV cache is reused
+    endpoints = await loop_endpoints()
+    return endpoints[zlib.crc32(state["question"].encode()) % len(endpoints)]
+
+
+def _chat_options(options: dict = None) -> dict:
+    return {"temperature": TEMPERTURE, **(options or {})}
+
+
+def chat_key(prompt: str, model: str = MODEL_NAME, options: dict = None,
+             until: re.Pattern = None, **kwargs) -> str:
+    return hashlib.blake2b(
+        json.dumps([model, _chat_options(options), kwargs, until and until.pattern, prompt],
+                   sort_keys=True).encode()
+    ).hexdigest()
+
+
+async def cached_chat(endpoint: tuple, prompt: str, model: str = MODEL_NAME,
+                      options: dict = None, until: re.Pattern = None, store: bool = True,
+                      **kwargs) -> str:
+    # With `until`, the reply is streamed and cut off as soon as the pattern matches.
+    # With store=False, the reply is not written to the cache (existing entries are still used).
+    key = chat_key(prompt, model, options, until, **kwargs)
+    options = _chat_options(options)
+    content = llm_cache.get(key)
+    if content is not None:
+        return content
+    # Identical prompts already in flight (e.g. duplicates within a batch) share one request
+    # Tasks can only be awaited on their own loop, so each loop tracks its own
+    inflight = _inflight_chats.setdefault(asyncio.get_running_loop(), {})
+    task = inflight.get(key)
+    if task is None:
+        # _chat only writes the cache when given a key
+        cache_key = key if store else None
+        task = asyncio.ensure_future(_chat(endpoint, cache_key, prompt, model, options, until, **kwargs))
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _chat(endpoint: tuple, key: str, prompt: str, model: str,
+                options: dict, until: re.Pattern, **kwargs) -> str:
+    client, slots = endpoint
+    messages = [{"role": "user", "content": prompt}]
+    async with slots:
+        if until is None:
+            response = await client.chat(model=model, options=options, messages=messages, **kwargs)
+            content = response['message']['content']
+        else:
+            stream = await client.chat(
+                model=model, options=options, messages=messages, stream=True, **kwargs
+            )
+            content = ""
+            try:
+                async for chunk in stream:
+                    content += chunk['message']['content']
+                    if until.search(content):
+                        break
+            finally:
+                # Closes the HTTP response instead of draining the rest of the body
+                await stream.aclose()
+    if key is not None:
+        llm_cache.set(key, content)
+    return content
+
+
+def static_issues(code: str) -> List[str]:
+    try:
+        tree = ast.parse(code)
+        # Dry-run compile also catches errors ast.parse accepts, e.g. 'return' outside a function
+        compile_code(code)
+    except (SyntaxError, ValueError) as e:
+        return [f"Syntax error: {e}"]
+    issues = []
+    # Same allowlist the sandbox enforces, so code that can't run is rejected before execution
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name.split(".")[0] not in ALLOWED_IMPORTS:
+                    issues.append(f"'import {alias.name}' is not allowed; import only numpy (or numba).")
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                issues.append("Relative imports are not allowed; import only numpy (or numba).")
+            elif (node.module or "").split(".")[0] not in ALLOWED_IMPORTS:
+                issues.append(f"'from {node.module} import ...' is not allowed; import only numpy (or numba).")
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id == "input":
+                issues.append("The code calls input(); pass values as function arguments instead.")
+            elif node.func.id in FORBIDDEN_BUILTINS:
+                issues.append(f"The code calls {node.func.id}(), which is not available when it runs.")
+    if not any(isinstance(node, ast.Name) and node.id == "result" and isinstance(node.ctx, ast.Store)
+               for node in ast.walk(tree)):
+        issues.append("The final result is not stored in a variable called 'result'.")
+    return issues
+
+
 def extract_code(text: str) -> str:
-    code_blocks = re.findall(r'```python\n(.*?)\n```', text, re.DOTALL)
-    return code_blocks[0] if code_blocks else text
+    m = _CODE_RE.search(text)
+    return m.group(1) if m else text
+
+
+def route_based_on_semantic_cache(state: GraphState):
+    if state["semantic_hit"]:
+        return "END"
+    return "check_math"
 
 
 def route_based_on_math(state: GraphState):
@@ -212,16 +600,24 @@ def route_based_on_math(state: GraphState):
     return "regular_response"
 
 
+def out_of_refinements(state: GraphState) -> bool:
+    return len(state.get("refinements", [])) >= MAX_REFINEMENTS
+
+
 def route_based_on_verification(state: GraphState):
     if state["verification_result"]["approved"]:
         return "execute_code"
+    if out_of_refinements(state):
+        return "refinement_limit"
     return "refine_code"
 
 
 def route_based_on_execution(state: GraphState):
     if state.get("execution_failed", False):
+        if out_of_refinements(state):
+            return "refinement_limit"
         return "refine_code"
-    return "END"
+    return "semantic_store"
 
 # ----------------------
 # Graph Setup
@@ -231,17 +627,30 @@ def route_based_on_execution(state: GraphState):
 workflow = StateGraph(GraphState)
 
 # Add nodes
+workflow.add_node("semantic_lookup", semantic_lookup)
 workflow.add_node("check_math", check_math_question)
 workflow.add_node("math_pipeline", generate_initial_code)
-workflow.add_node("verify_code", verify_code)
+workflow.add_node("verify_static", verify_static)
+workflow.add_node("verify_llm", verify_llm)
+workflow.add_node("join_verify", join_verify)
 workflow.add_node("refine_code", refine_code)
 workflow.add_node("execute_code", execute_code)
+workflow.add_node("semantic_store", semantic_store)
+workflow.add_node("refinement_limit", refinement_limit)
 workflow.add_node("regular_response", regular_response)
 
 # Set entry point
-workflow.set_entry_point("check_math")
+workflow.set_entry_point("semantic_lookup")
 
 # Add edges
+workflow.add_conditional_edges(
+    "semantic_lookup",
+    route_based_on_semantic_cache,
+    {
+        "check_math": "check_math",
+        "END": END
+    }
+)
 workflow.add_conditional_edges(
     "check_math",
     route_based_on_math,
@@ -251,26 +660,118 @@ workflow.add_conditional_edges(
     }
 )
 
-workflow.add_edge("math_pipeline", "verify_code")
+# Static and LLM verification run as parallel branches and meet in join_verify.
+# refine_code verifies its own output, so only the static branch follows it.
+workflow.add_edge("math_pipeline", "verify_static")
+workflow.add_edge("math_pipeline", "verify_llm")
+workflow.add_edge("refine_code", "verify_static")
+workflow.add_edge("verify_static", "join_verify")
+workflow.add_edge("verify_llm", "join_verify")
 workflow.add_conditional_edges(
-    "verify_code",
+    "join_verify",
     route_based_on_verification,
     {
         "execute_code": "execute_code",
-        "refine_code": "refine_code"
+        "refine_code": "refine_code",
+        "refinement_limit": "refinement_limit"
     }
 )
 
-workflow.add_edge("refine_code", "verify_code")
 # Instead of routing directly to END, check if execution succeeds
 workflow.add_conditional_edges(
     "execute_code",
     route_based_on_execution,
     {
         "refine_code": "refine_code",
-        "END": END
+        "semantic_store": "semantic_store",
+        "refinement_limit": "refinement_limit"
     }
 )
+workflow.add_edge("semantic_store", END)
+workflow.add_edge("refinement_limit", END)
 workflow.add_edge("regular_response", END)
 
 graph = workflow.compile()
+
+# ----------------------
+# Warm-up
+# ----------------------
+
+
+def warm_up(host: str = None):
+    # Loads every model before the first real query and keeps them resident.
+    # Each model is tried on its own: a missing one (reported by the first real
+    # request) must not keep the others cold.
+    client = ollama.Client(host=host)
+    models = (GATE_MODEL, MODEL_NAME) + ((VERIFY_MODEL,) if VERIFY_WITH_LLM else ())
+    for model in models:
+        try:
+            client.chat(
+                model=model,
+                messages=[{"role": "user", "content": "hi"}],
+                options={"num_predict": 1},
+                keep_alive=-1
+            )
+        except (ollama.ResponseError, httpx.HTTPError, ConnectionError):
+            pass
+    try:
+        client.embed(model=EMBED_MODEL, input="hi", keep_alive=-1)
+    except (ollama.ResponseError, httpx.HTTPError, ConnectionError):
+        pass
+
+
+def startup():
+    if os.getenv("OLLAMA_WARMUP", "1") != "0":
+        for host in OLLAMA_HOSTS:
+            warm_up(host)
+
+
+threading.Thread(target=startup, daemon=True).start()
+
+
+# ----------------------
+# Batch Execution
+# ----------------------
+
+
+async def batch_check_math(questions: List[str]) -> List[bool]:
+    # Dispatch every gate prompt at once so the server can schedule them together
+    results = await asyncio.gather(*[
+        check_math_question({"question": q}) for q in questions
+    ])
+    return [r["math_related"] for r in results]
+
+
+async def run_batch(questions: List[str], batch_size: int = None):
+    # batch_size=None submits the whole batch at once; the per-endpoint semaphores
+    # still cap how many chat requests reach each server concurrently.
+    # Repeated questions run once and share the resulting state.
+    unique = list(dict.fromkeys(questions))
+    results = await graph.abatch(
+        [{"question": q} for q in unique],
+        config={"max_concurrency": batch_size, "recursion_limit": GRAPH_RECURSION_LIMIT},
+        return_exceptions=True
+    )
+    by_question = {}
+    for question, result in zip(unique, results):
+        if isinstance(result, Exception):
+            # One failing question doesn't discard the answers of the others
+            result = {
+                "question": question,
+                "final_answer": f"Error while solving this question: {type(result).__name__}: {result}"
+            }
+        by_question[question] = result
+    return [by_question[q] for q in questions]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Solve math questions with generated NumPy code.")
+    parser.add_argument("questions", nargs="+", help="questions to solve")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="maximum number of questions processed concurrently (default: all)")
+    args = parser.parse_args()
+
+    for result in asyncio.run(run_batch(args.questions, args.batch_size)):
+        print(result["final_answer"])
@@ -0,0 +1,113 @@
+import os
+import sys
+import builtins
+import functools
+import io
+import marshal
+import math
+import subprocess
+import traceback
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Generated code runs in a fresh interpreter on this file rather than a multiprocessing
+# child: spawn and forkserver would re-import main (langgraph, faiss, the caches and the
+# graph) on every run, and fork would copy a process with live event loop and warm-up threads.
+# This module only imports what generated code may use.
+
+# ----------------------
+# Execution Limits
+# ----------------------
+EXECUTION_TIMEOUT = float(os.getenv("EXECUTION_TIMEOUT", "15"))
+# Address-space cap for the child process (POSIX only); 0 disables it.
+EXECUTION_MEMORY_LIMIT_MB = int(os.getenv("EXECUTION_MEMORY_LIMIT_MB", "4096"))
+# Top-level modules generated code may import
+ALLOWED_IMPORTS = {"numpy", "numba", "math"}
+# Builtins removed from the execution namespace
+FORBIDDEN_BUILTINS = ("input", "open", "exec", "eval")
+
+
+def _restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name.split(".")[0] not in ALLOWED_IMPORTS:
+        raise ImportError(f"Import of '{name}' is not allowed in generated code")
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+# input()/open()/exec()/eval() are unavailable to generated code; imports go through the allowlist
+_RESTRICTED_BUILTINS = {
+    name: value for name, value in builtins.__dict__.items()
+    if name not in FORBIDDEN_BUILTINS
+}
+_RESTRICTED_BUILTINS["__import__"] = _restricted_import
+
+
+@functools.lru_cache(maxsize=256)
+def compile_code(src: str):
+    # Retries that re-execute identical code skip parsing and AST building
+    return compile(src, "<generated>", "exec")
+
+
+def _names(code) -> set:
+    # Global names referenced anywhere in the code, nested functions included
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, "co_names"):
+            names |= _names(const)
+    return names
+
+
+def _run_user_code():
+    # Child process entry point: bytecode on stdin, marshaled (printed output, error, stack trace) on stdout
+    code = marshal.loads(sys.stdin.buffer.read())
+    if resource is not None and EXECUTION_MEMORY_LIMIT_MB > 0:
+        limit = EXECUTION_MEMORY_LIMIT_MB * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    # Generated code starts with its modules already bound; numba costs ~0.2 s to import,
+    # so it is only loaded for code that uses it
+    namespace = {"np": np, "math": math, "__builtins__": _RESTRICTED_BUILTINS}
+    if {"numba", "nb"} & _names(code):
+        import numba
+        namespace.update(numba=numba, nb=numba)
+    # Capture printed output
+    output_capture = io.StringIO()
+    sys.stdout = output_capture
+    try:
+        exec(code, namespace)
+        result = (output_capture.getvalue(), None, None)
+    except BaseException as e:
+        result = (output_capture.getvalue(), str(e) or type(e).__name__, traceback.format_exc())
+    sys.__stdout__.buffer.write(marshal.dumps(result))
+
+
+def run_sandboxed(src: str):
+    try:
+        bytecode = marshal.dumps(compile_code(src))
+    except (SyntaxError, ValueError) as e:
+        return "", str(e), traceback.format_exc()
+
+    try:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__)],
+            input=bytecode,
+            capture_output=True,
+            timeout=EXECUTION_TIMEOUT
+        )
+    except subprocess.TimeoutExpired:
+        # subprocess.run has already killed the child
+        return "", f"Execution timed out after {EXECUTION_TIMEOUT:g} seconds", ""
+    try:
+        return marshal.loads(proc.stdout)
+    except (EOFError, ValueError, TypeError):
+        return "", f"Execution process died with exit code {proc.returncode}", ""
+
+
+if __name__ == "__main__":
+    _run_user_code()